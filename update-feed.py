@@ -3,9 +3,11 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import csv
 import datetime
+import math
 from typing import List, Tuple, Optional
-import json
+import orjson
 import sqlite3
 import subprocess
 import os
@@ -13,10 +15,20 @@ import tomllib
 import sys
 import unicodedata
 import re
+import queue
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from hashlib import sha256
 from pathlib import Path
 from difflib import SequenceMatcher
 
+import numpy as np
+import requests
+import requests_cache
+from scipy.spatial import cKDTree
+
 from pyhafas import HafasClient
 from pyhafas.profile import OEBBProfile
 from pyhafas.types.fptf import Leg, Mode
@@ -24,33 +36,90 @@ from pyhafas.types.exceptions import GeneralHafasError
 
 
 def prepare_database(sqlite_filename):
-    db = sqlite3.connect(sqlite_filename)
+    # isolation_level=None stops the sqlite3 module from opening
+    # transactions behind our back; the explicit BEGIN/COMMIT around
+    # the batched inserts is the only transaction handling.
+    # check_same_thread=False is needed because all writes after setup
+    # happen on the writer thread.
+    # The multi-row insert statements vary in their number of VALUES
+    # groups, so give sqlite3 a larger statement cache than the
+    # default 128 to keep them all prepared
+    db = sqlite3.connect(
+        sqlite_filename,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=256,
+    )
     cur = db.cursor()
     cur.executescript(
         """
-    CREATE TABLE IF NOT EXISTS `agencies` (`agency_id` text PRIMARY KEY NOT NULL, `agency_name` text NOT NULL, `agency_url` text NOT NULL, `agency_timezone` text NOT NULL, `agency_phone` text DEFAULT NULL, `agency_fare_url` text DEFAULT NULL,  `agency_email` text DEFAULT NULL);
-    CREATE TABLE IF NOT EXISTS `calendar_dates` (`service_id` text NOT NULL, `date` integer NOT NULL,`exception_type` integer NOT NULL, PRIMARY KEY(`service_id`, `date`));
-    CREATE TABLE IF NOT EXISTS `routes` (`route_id` text PRIMARY KEY NOT NULL, `agency_id` text NOT NULL, `route_short_name` text DEFAULT NULL, `route_long_name` text DEFAULT NULL, `route_desc` text DEFAULT NULL, `route_type` smallint NOT NULL, `route_url` text DEFAULT NULL, `route_color` text DEFAULT NULL, `route_text_color` text DEFAULT NULL, `route_sort_order` smallint DEFAULT NULL);
-    CREATE TABLE IF NOT EXISTS `stops` (`stop_id` text PRIMARY KEY NOT NULL, `stop_code` text DEFAULT NULL, `stop_name` text NOT NULL, `tts_stop_name` text DEFAULT NULL, `stop_desc` text DEFAULT NULL, `stop_lat` real NOT NULL, `stop_lon` real NOT NULL, `zone_id` text DEFAULT NULL, `stop_url` text DEFAULT NULL, `location_type` integer DEFAULT NULL, `parent_station` text DEFAULT NULL, `stop_timezone`, `wheelchair_boarding` integer DEFAULT NULL, `level_id` text DEFAULT NULL, `platform_code` text DEFAULT NULL);
+    PRAGMA page_size=8192;
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    CREATE TABLE IF NOT EXISTS `agencies` (`agency_id` text PRIMARY KEY NOT NULL, `agency_name` text NOT NULL, `agency_url` text NOT NULL, `agency_timezone` text NOT NULL, `agency_phone` text DEFAULT NULL, `agency_fare_url` text DEFAULT NULL,  `agency_email` text DEFAULT NULL) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS `calendar_dates` (`service_id` text NOT NULL, `date` integer NOT NULL,`exception_type` integer NOT NULL, PRIMARY KEY(`service_id`, `date`)) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS `routes` (`route_id` text PRIMARY KEY NOT NULL, `agency_id` text NOT NULL, `route_short_name` text DEFAULT NULL, `route_long_name` text DEFAULT NULL, `route_desc` text DEFAULT NULL, `route_type` smallint NOT NULL, `route_url` text DEFAULT NULL, `route_color` text DEFAULT NULL, `route_text_color` text DEFAULT NULL, `route_sort_order` smallint DEFAULT NULL) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS `stops` (`stop_id` text PRIMARY KEY NOT NULL, `stop_code` text DEFAULT NULL, `stop_name` text NOT NULL, `tts_stop_name` text DEFAULT NULL, `stop_desc` text DEFAULT NULL, `stop_lat` real NOT NULL, `stop_lon` real NOT NULL, `zone_id` text DEFAULT NULL, `stop_url` text DEFAULT NULL, `location_type` integer DEFAULT NULL, `parent_station` text DEFAULT NULL, `stop_timezone`, `wheelchair_boarding` integer DEFAULT NULL, `level_id` text DEFAULT NULL, `platform_code` text DEFAULT NULL) WITHOUT ROWID;
     CREATE TABLE IF NOT EXISTS `stop_times` (`trip_id` text NOT NULL, `arrival_time` text DEFAULT NULL, `departure_time` text DEFAULT NULL, `stop_id` text NOT NULL, `location_group_id` text, `location_id` text, `stop_sequence` smallint NOT NULL, `stop_headsign` text DEFAULT NULL, `pickup_type` integer DEFAULT NULL, `drop_off_type` integer DEFAULT NULL, `timepoint` integer DEFAULT NULL, PRIMARY KEY(`trip_id`, `stop_sequence`));
-    CREATE TABLE IF NOT EXISTS `trips` (`route_id` text NOT NULL, `service_id` text NOT NULL, `trip_id` text PRIMARY KEY NOT NULL, `trip_headsign` text DEFAULT NULL, `trip_short_name` text DEFAULT NULL, `direction_id` integer DEFAULT NULL, `block_id` text DEFAULT NULL, `shape_id` text DEFAULT NULL, `wheelchair_accessible` integer DEFAULT NULL, `bikes_allowed` integer DEFAULT NULL);
-    CREATE TABLE IF NOT EXISTS `feed_info` (`feed_publisher_name` text PRIMARY KEY NOT NULL, `feed_publisher_url` text NOT NULL, `feed_lang` text NOT NULL, `feed_contact_email` text);
+    CREATE TABLE IF NOT EXISTS `trips` (`route_id` text NOT NULL, `service_id` text NOT NULL, `trip_id` text PRIMARY KEY NOT NULL, `trip_headsign` text DEFAULT NULL, `trip_short_name` text DEFAULT NULL, `direction_id` integer DEFAULT NULL, `block_id` text DEFAULT NULL, `shape_id` text DEFAULT NULL, `wheelchair_accessible` integer DEFAULT NULL, `bikes_allowed` integer DEFAULT NULL) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS `feed_info` (`feed_publisher_name` text PRIMARY KEY NOT NULL, `feed_publisher_url` text NOT NULL, `feed_lang` text NOT NULL, `feed_contact_email` text) WITHOUT ROWID;
     """
     )
     return (db, cur)
 
 
-def get_stations():
-    stops_geojson = json.load(open("stations.geojson", "r"))
-    stations = stops_geojson["features"]
+class StationIndex:
+    def __init__(self, stations):
+        self.stations = stations
 
-    stations.sort(key=lambda s: s["geometry"]["coordinates"][0])
-    stations.sort(key=lambda s: s["geometry"]["coordinates"][1])
-    return stations
+        # Keep the coordinates in contiguous arrays instead of reaching
+        # through the feature dicts on every lookup
+        self.lats = np.fromiter(
+            (s["geometry"]["coordinates"][1] for s in stations), dtype=np.float64
+        )
+        self.lons = np.fromiter(
+            (s["geometry"]["coordinates"][0] for s in stations), dtype=np.float64
+        )
+
+        # Index the stations spatially, so close stations can be found in
+        # O(log n) instead of scanning the whole list per lookup
+        self.tree = cKDTree(np.column_stack((self.lats, self.lons)))
+
+        self.ibnr_index = {}
+        for index, station in enumerate(stations):
+            if "ref:ibnr" in station["properties"]:
+                self.ibnr_index.setdefault(station["properties"]["ref:ibnr"], []).append(index)
+
+        # The display name of a feature never changes, so resolve the
+        # name priority once at load time instead of per stopover.
+        # Normalizing the OSM names costs Unicode decomposition and
+        # regex passes, so that is also done once per feature here.
+        for station in stations:
+            station["_name"] = station_name_fallback(station)
+            station["_normalized_names"] = [
+                normalize_name(value)
+                for prop, value in station["properties"].items()
+                if prop.startswith(("name", "alt_name", "int_name"))
+            ]
+            properties = station["properties"]
+            # Stations and halts are preferred over yards and
+            # disused / abandoned nodes, which is another property of
+            # the tags that can be decided once at load time
+            station["_preferred"] = (
+                properties.get("railway") in ("station", "halt")
+                or properties.get("public_transport") == "station"
+            ) and (
+                "abandoned:railway" not in properties
+                and "disused:railway" not in properties
+            )
 
 
-def distance(a: Tuple[float, float], b: Tuple[float, float]):
-    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2
+def get_stations():
+    with open("stations.geojson", "rb") as f:
+        stops_geojson = orjson.loads(f.read())
+    return StationIndex(stops_geojson["features"])
 
 
 class Stop:
@@ -67,21 +136,7 @@ def choose_best_osm_node(candidates, stop):
 
     for candidate in candidates:
         # Prefer stations and halts over yards and disused / abandoned nodes
-        if (
-            (
-                "railway" in candidate["properties"]
-                and (
-                    candidate["properties"]["railway"] == "station"
-                    or candidate["properties"]["railway"] == "halt"
-                )
-                or (
-                    "public_transport" in candidate["properties"]
-                    and "public_transport" in candidate["properties"] == "station"
-                )
-            )
-            and "abandoned:railway" not in candidate["properties"]
-            and "disused:railway" not in candidate["properties"]
-        ):
+        if candidate["_preferred"]:
             return candidate
     else:
         # If nothing obvious was found, use the next best thing
@@ -89,16 +144,31 @@ def choose_best_osm_node(candidates, stop):
 
 
 def strip_accents(s):
+    # Pure ASCII names cannot contain accents, skip the normalization
+    if s.isascii():
+        return s
     return "".join(c for c in unicodedata.normalize("NFD", s) if unicodedata.category(c) != "Mn")
 
 
+PAREN_RE = re.compile(r"\(.*?\)")
+STAJALISTE_RE = re.compile(r"Stajaliste | Stajaliste")
+
+
 def normalize_name(name):
-    return (
-        re.sub(r"\(.*\)", "", strip_accents(name))
-        .replace("Stajaliste ", "")
-        .replace(" Stajaliste", "")
-        .lower()
-    )
+    # Accents must be stripped first so "Stajalište" is caught too
+    name = PAREN_RE.sub("", strip_accents(name))
+    return STAJALISTE_RE.sub("", name).lower()
+
+
+@lru_cache(maxsize=4096)
+def matcher_for(match_name):
+    # SequenceMatcher caches its analysis of the second sequence, so
+    # keep the stop name there and swap the OSM names in as the first.
+    # Stops repeat across trips, so the matchers themselves are cached
+    # by name as well.
+    matcher = SequenceMatcher(None)
+    matcher.set_seq2(match_name)
+    return matcher
 
 
 def station_name_matches(osm_station, name):
@@ -107,48 +177,96 @@ def station_name_matches(osm_station, name):
     Returns False if the two are unlikely to be the same.
     """
     match_name = normalize_name(name)
-    matcher = SequenceMatcher(None, match_name)
-    match = False
-    for prop, value in osm_station["properties"].items():
-        if prop.startswith("name") or prop.startswith("alt_name") or prop.startswith("int_name"):
-            osm_name = normalize_name(value)
-            matcher.set_seq2(osm_name)
-            if matcher.ratio() > 0.75:
-                match = True
+    matcher = matcher_for(match_name)
+    for osm_name in osm_station["_normalized_names"]:
+        # The substring test is by far the cheapest check, so run it first
+        if osm_name and match_name and (osm_name in match_name or match_name in osm_name):
+            return True
+
+        # real_quick_ratio and quick_ratio are increasingly tight upper
+        # bounds of ratio, so they can cheaply rule out most
+        # non-matches before the full matcher runs
+        matcher.set_seq1(osm_name)
+        if (
+            matcher.real_quick_ratio() > 0.75
+            and matcher.quick_ratio() > 0.75
+            and matcher.ratio() > 0.75
+        ):
+            return True
 
-            if osm_name and match_name and (osm_name in match_name or match_name in osm_name):
-                match = True
+    return False
 
-    return match
 
+trip_cache = {}
 
-def search_station(stations, stop):
-    osm_stop = Stop()
 
-    candidates = []
+def fetch_trip(client, trip_id):
+    """
+    Fetches a trip from HAFAS, or returns it from the cache if it was
+    already requested. The same trip shows up in many departure and
+    arrival boards, so this saves a lot of HTTP round trips.
+    """
+    if trip_id not in trip_cache:
+        trip_cache[trip_id] = client.trip(trip_id)
+    return trip_cache[trip_id]
 
-    for station in stations:
-        if (
-            distance(
-                (
-                    station["geometry"]["coordinates"][1],
-                    station["geometry"]["coordinates"][0],
-                ),
-                (stop.latitude, stop.longitude),
+
+def prefetch_trips(client, departures):
+    """
+    Fills the trip cache from multiple threads, so the HAFAS round
+    trips overlap instead of being paid one after another. Errors are
+    ignored here and surface when the trip is fetched again serially.
+    """
+
+    def fetch(departure):
+        try:
+            fetch_trip(client, departure.id)
+        except GeneralHafasError:
+            pass
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(fetch, departures))
+
+
+station_cache_by_id = {}
+station_cache_by_coord = {}
+
+
+def search_station(station_index, stop):
+    # The same stop id recurs for every trip passing through a
+    # station, so try the cheap id lookup before anything else
+    if stop.id is not None and stop.id in station_cache_by_id:
+        return station_cache_by_id[stop.id]
+
+    coord_key = (stop.latitude, stop.longitude, stop.name)
+    if coord_key in station_cache_by_coord:
+        return station_cache_by_coord[coord_key]
+
+    osm_stop = Stop()
+
+    # Features tagged with the stop's ibnr win over everything else
+    # anyway, so skip the spatial query and name matching entirely
+    # when there is such a match
+    candidate_indexes = station_index.ibnr_index.get(stop.id)
+    if candidate_indexes is None:
+        candidate_indexes = [
+            index
+            for index in station_index.tree.query_ball_point(
+                (stop.latitude, stop.longitude), math.sqrt(0.00002)
             )
-            < 0.00002
-            and station_name_matches(station, stop.name)
-        ) or ("ref:ibnr" in station["properties"] and station["properties"]["ref:ibnr"] == stop.id):
-            candidates.append(station)
+            if station_name_matches(station_index.stations[index], stop.name)
+        ]
+
+    candidates = [station_index.stations[index] for index in candidate_indexes]
 
     if candidates:
         osm_node = choose_best_osm_node(candidates, stop)
 
-        osm_stop.name = station_name_fallback(osm_node)
+        osm_stop.name = osm_node["_name"]
+        if osm_stop.name is None:
+            raise Exception(f"No matching property found in {osm_node["properties"]}")
         osm_stop.lat = osm_node["geometry"]["coordinates"][1]
         osm_stop.lon = osm_node["geometry"]["coordinates"][0]
-
-        return osm_stop
     else:
         print(
             f"Did not find {stop.name} ({stop.id}) in OSM data near {stop.latitude}, {stop.longitude}"
@@ -156,36 +274,34 @@ def search_station(stations, stop):
         osm_stop.name = stop.name
         osm_stop.lat = stop.latitude
         osm_stop.lon = stop.longitude
-        return osm_stop
 
+    if stop.id is not None:
+        station_cache_by_id[stop.id] = osm_stop
+    station_cache_by_coord[coord_key] = osm_stop
+    return osm_stop
 
-def mode_to_route_type(mode, route_type: Optional[str]):
-    match mode:
-        case Mode.BUS:
-            return 3
-        case Mode.TRAIN:
-            match route_type:
-                case "R":
-                    return 106
-                case "E":
-                    return 106
-                case "IC":
-                    return 102
-                case "EC":
-                    return 102
-                case "D":
-                    return 102
-                case None:
-                    return 2
-                case _:
-                    print("Unknown train type", route_type)
-                    return 2
 
-    raise Exception("Unknown mode")
+TRAIN_ROUTE_TYPES = {
+    "R": 106,
+    "E": 106,
+    "IC": 102,
+    "EC": 102,
+    "D": 102,
+    None: 2,
+}
 
 
-def service_id(trip_id):
-    return sha256(("service" + trip.id).encode()).hexdigest()
+def mode_to_route_type(mode, route_type: Optional[str]):
+    if mode == Mode.BUS:
+        return 3
+    if mode == Mode.TRAIN:
+        if route_type in TRAIN_ROUTE_TYPES:
+            return TRAIN_ROUTE_TYPES[route_type]
+
+        print("Unknown train type", route_type)
+        return 2
+
+    raise Exception("Unknown mode")
 
 
 def split_trip_name(name: str) -> Tuple[Optional[str], str]:
@@ -196,28 +312,154 @@ def split_trip_name(name: str) -> Tuple[Optional[str], str]:
         return (None, name)
 
 
-def time_to_gtfs(start_date, time):
-    rel_time = time - datetime.datetime.combine(
-        start_date,
-        datetime.datetime.min.time(),
-        tzinfo=time.tzinfo,
-    )
-    seconds = int(rel_time.total_seconds())
-    result = f"{seconds // (60 * 60):02}:{seconds % (60 * 60) // 60:02}:{seconds % 60:02}"
-    return result
+def time_to_gtfs(day_start_timestamp, time):
+    seconds = int(time.timestamp()) - day_start_timestamp
+    (hours, rest) = divmod(seconds, 60 * 60)
+    (minutes, seconds) = divmod(rest, 60)
+    return f"{hours:02}:{minutes:02}:{seconds:02}"
+
+
+NAME_PRIORITY = ("name:sr-Latn", "name:en", "name")
 
 
 def station_name_fallback(station):
-    priority = ["name:sr-Latn", "name:en", "name"]
+    properties = station["properties"]
 
-    for prop in priority:
-        if prop in station["properties"]:
-            return station["properties"][prop].strip(
+    for prop in NAME_PRIORITY:
+        value = properties.get(prop)
+        if value is not None:
+            return value.strip(
                 "[]"
             )  # Some railway stations are abandoned but trains still seem to stop there.
             # Strip away OSMs abandoned markers in the name.
 
-    raise Exception(f"No matching property found in {station["properties"]}")
+    # A few features have no usable name at all; they only become a
+    # problem if one of them is actually picked for a stop
+    return None
+
+
+# SQLite allows at most 32766 bound parameters per statement
+MAX_SQL_VARIABLES = 32766
+
+routes_rows = []
+trips_rows = []
+calendar_dates_rows = []
+stops_rows = []
+stop_times_rows = []
+
+# Rows already written this run; rewriting them would just replace
+# identical rows
+seen_stops = set()
+seen_routes = set()
+seen_calendar_dates = set()
+
+
+# Small helpers that fill in the unused columns of each table, so the
+# hot loops only spell out the values that actually vary
+
+
+def route_row(route_id, agency_id, long_name, route_type, color, text_color):
+    return (route_id, agency_id, None, long_name, None, route_type, None, color, text_color, None)
+
+
+def trip_row(route_id, service, trip_id, headsign, short_name):
+    return (route_id, service, trip_id, headsign, short_name, None, None, None, None, None)
+
+
+def stop_row(stop_id, name, lat, lon, timezone):
+    return (stop_id, None, name, None, None, lat, lon, None, None, 0, None, timezone, None, None, None)
+
+
+def stop_time_row(trip_id, arrival_time, departure_time, stop_id, sequence):
+    # timepoint=1: exact times
+    return (trip_id, arrival_time, departure_time, stop_id, None, None, sequence, None, None, None, 1)
+
+
+def insert_rows(cur, table, column_count, rows):
+    """
+    Inserts rows using multi-row VALUES statements, so one
+    prepare/step cycle covers a whole batch instead of a single row.
+    """
+    placeholders = "(" + ", ".join("?" * column_count) + ")"
+    batch_size = MAX_SQL_VARIABLES // column_count
+
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start : start + batch_size]
+        cur.execute(
+            f"insert or replace into {table} values "
+            + ", ".join([placeholders] * len(batch)),
+            [value for row in batch for value in row],
+        )
+
+
+# Errors from the writer thread, to be re-raised on the main thread.
+# Dying silently instead would leave the main thread blocked forever
+# on the bounded queue or on join().
+writer_error = None
+
+
+def flush_rows(write_queue):
+    """
+    Hands all buffered rows to the writer thread. Each buffer is
+    sorted by its table's primary key first, which keeps the B-tree
+    inserts append-friendly instead of jumping around in the index.
+    """
+    if writer_error is not None:
+        raise writer_error
+
+    routes_rows.sort(key=lambda row: row[0])
+    trips_rows.sort(key=lambda row: row[2])
+    calendar_dates_rows.sort(key=lambda row: (row[0], row[1]))
+    stops_rows.sort(key=lambda row: row[0])
+    stop_times_rows.sort(key=lambda row: (row[0], row[6]))
+
+    write_queue.put(
+        [
+            ("routes", 10, routes_rows.copy()),
+            ("trips", 10, trips_rows.copy()),
+            ("calendar_dates", 3, calendar_dates_rows.copy()),
+            ("stops", 15, stops_rows.copy()),
+            ("stop_times", 11, stop_times_rows.copy()),
+        ]
+    )
+
+    routes_rows.clear()
+    trips_rows.clear()
+    calendar_dates_rows.clear()
+    stops_rows.clear()
+    stop_times_rows.clear()
+
+
+def database_writer(db, write_queue):
+    """
+    Runs on a background thread and owns all database writes, so
+    fetching trips and committing batches overlap. Every queue entry
+    is a list of (table, column_count, rows) batches that are written
+    in one transaction; None shuts the thread down.
+    """
+    global writer_error
+    cur = db.cursor()
+
+    while True:
+        batches = write_queue.get()
+        try:
+            if batches is None:
+                break
+
+            # After a failure just drain the queue, so the producer's
+            # put() and join() calls still return and the error can
+            # surface on the main thread
+            if writer_error is not None:
+                continue
+
+            cur.execute("BEGIN")
+            for table, column_count, rows in batches:
+                insert_rows(cur, table, column_count, rows)
+            db.commit()
+        except BaseException as e:
+            writer_error = e
+        finally:
+            write_queue.task_done()
 
 
 with open(sys.argv[1], "rb") as cf:
@@ -227,12 +469,63 @@ with open(sys.argv[1], "rb") as cf:
 database_file = config["operator"]["id"] + ".sqlite"
 (db, cur) = prepare_database(database_file)
 
-for search_name in config["data"]["stations"]:
-    print(f"# Fetching data for {search_name}")
+# Collect inserts into large explicit transactions instead of paying
+# journal and fsync overhead per statement
+write_queue = queue.Queue(maxsize=16)
+# A daemon thread, so an exception on the main thread (including a
+# KeyboardInterrupt outside the fetch loop) still lets the process
+# exit; the normal shutdown path below joins it explicitly
+writer_thread = threading.Thread(target=database_writer, args=(db, write_queue), daemon=True)
+writer_thread.start()
+stopovers_since_flush = 0
+
+station_index = get_stations()
+client = HafasClient(OEBBProfile())
+
+# Cache HAFAS responses on disk for a while, so restarted or repeated
+# runs do not pay (and cause) the same HTTP round trips again.
+# pyhafas sends everything through this session, as POST requests,
+# which requests-cache does not cache unless told to (it keys the
+# entries by request body, so different queries miss independently).
+client.profile.request_session = requests_cache.CachedSession(
+    "hafas_cache",
+    backend="sqlite",
+    expire_after=3600,
+    allowable_methods=("GET", "HEAD", "POST"),
+)
 
-    stations = get_stations()
+# The prefetch threads all fetch from the same host; a larger
+# connection pool lets them keep their own TLS connections alive
+# instead of handshaking again whenever the default pool overflows
+client.profile.request_session.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32)
+)
 
-    client = HafasClient(OEBBProfile())
+# The agency only depends on the config, there is no need to rewrite
+# it for every fetched page
+operator_config = config["operator"]
+write_queue.put(
+    [
+        (
+            "agencies",
+            7,
+            [
+                (
+                    operator_config["id"],
+                    operator_config["name"],
+                    operator_config["url"],
+                    "Europe/Vienna",
+                    operator_config["phone"],
+                    None,
+                    operator_config["email"],
+                )
+            ],
+        )
+    ]
+)
+
+for search_name in config["data"]["stations"]:
+    print(f"# Fetching data for {search_name}")
 
     locations = client.locations(search_name)
     best_found_location = locations[0]
@@ -249,9 +542,21 @@ for search_name in config["data"]["stations"]:
 
     print(f"Starting at {latest_time}")
 
-    cur.execute(
-        """insert or replace into feed_info values ("Jonah Brüchert", "https://jbb.ghsq.de", ?, "jbb@kaidan.im")""",
-        (config["operator"]["lang"],),
+    write_queue.put(
+        [
+            (
+                "feed_info",
+                4,
+                [
+                    (
+                        "Jonah Brüchert",
+                        "https://jbb.ghsq.de",
+                        config["operator"]["lang"],
+                        "jbb@kaidan.im",
+                    )
+                ],
+            )
+        ]
     )
 
     # Try to fetch until hafas complains
@@ -282,119 +587,108 @@ for search_name in config["data"]["stations"]:
             latest_departure = departures[-1].dateTime
             latest_arrival = departures[-1].dateTime
 
-            operator_config = config["operator"]
-            cur.execute(
-                """insert or replace into agencies values (?, ?, ?, "Europe/Vienna", ?, NULL, ?)""",
-                (
-                    operator_config["id"],
-                    operator_config["name"],
-                    operator_config["url"],
-                    operator_config["phone"],
-                    operator_config["email"],
-                ),
-            )
+            # A train that arrives here usually also departs again, so
+            # the two boards overlap a lot; process each leg only once
+            seen_leg_ids = set()
+            unique_departures = []
+            for departure in departures:
+                if departure.id not in seen_leg_ids:
+                    seen_leg_ids.add(departure.id)
+                    unique_departures.append(departure)
+            departures = unique_departures
+
+            prefetch_trips(client, departures)
 
             for departure in departures:
-                trip = client.trip(departure.id)
+                trip = fetch_trip(client, departure.id)
                 (route_type, trip_name) = split_trip_name(trip.name)
 
-                start = search_station(stations, trip.stopovers[0].stop)
-                dest = search_station(stations, trip.stopovers[-1].stop)
-
-                cur.execute(
-                    """insert or replace into routes values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (
-                        trip.name,
-                        operator_config["id"],
-                        None,
-                        f"{start.name} - {dest.name}",
-                        None,
-                        mode_to_route_type(trip.mode, route_type),
-                        None,
-                        operator_config["color"],
-                        operator_config["text_color"],
-                        None,
-                    ),
-                )
-                cur.execute(
-                    """insert or replace into trips values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (
-                        trip.name,
-                        service_id(trip.id),
-                        sha256(trip.id.encode()).hexdigest(),
-                        dest.name,
-                        trip_name,
-                        None,
-                        None,
-                        None,
-                        None,
-                        None,
-                    ),
+                # The same hashes are needed for every stopover row, so
+                # encode the id and compute them once per trip
+                trip_id_bytes = trip.id.encode()
+                trip_hash = sha256(trip_id_bytes).hexdigest()
+                trip_service_id = sha256(b"service" + trip_id_bytes).hexdigest()
+
+                # Stop times are relative to midnight of the trip's
+                # first day, which is the same for every stopover
+                start_date = trip.departure.date()
+                day_start_timestamp = int(
+                    datetime.datetime.combine(
+                        start_date,
+                        datetime.datetime.min.time(),
+                        tzinfo=trip.departure.tzinfo,
+                    ).timestamp()
                 )
 
-                if trip.cancelled:
-                    cur.execute(
-                        """insert or replace into calendar_dates values (?, ?, ?)""",
-                        (service_id(trip.id), trip.departure.date().strftime("%Y%m%d"), 0),
-                    )
-                else:
-                    cur.execute(
-                        """insert or replace into calendar_dates values (?, ?, ?)""",
-                        (service_id(trip.id), trip.departure.date().strftime("%Y%m%d"), 1),
+                start = search_station(station_index, trip.stopovers[0].stop)
+                dest = search_station(station_index, trip.stopovers[-1].stop)
+
+                if trip.name not in seen_routes:
+                    seen_routes.add(trip.name)
+                    routes_rows.append(
+                        route_row(
+                            trip.name,
+                            operator_config["id"],
+                            f"{start.name} - {dest.name}",
+                            mode_to_route_type(trip.mode, route_type),
+                            operator_config["color"],
+                            operator_config["text_color"],
+                        )
                     )
+                trips_rows.append(
+                    trip_row(trip.name, trip_service_id, trip_hash, dest.name, trip_name)
+                )
+
+                calendar_date = (
+                    trip_service_id,
+                    start_date.strftime("%Y%m%d"),
+                    0 if trip.cancelled else 1,
+                )
+                if calendar_date not in seen_calendar_dates:
+                    seen_calendar_dates.add(calendar_date)
+                    calendar_dates_rows.append(calendar_date)
 
                 sequence = 1
                 for stopover in trip.stopovers:
-                    station_metadata = search_station(stations, stopover.stop)
-
-                    cur.execute(
-                        """insert or replace into stops values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                        (
-                            stopover.stop.id,
-                            None,
-                            station_metadata.name,
-                            None,
-                            None,
-                            station_metadata.lat,
-                            station_metadata.lon,
-                            None,
-                            None,
-                            0,
-                            None,
-                            config["data"]["timezone"],
-                            None,
-                            None,
-                            None,
-                        ),
-                    )
+                    station_metadata = search_station(station_index, stopover.stop)
+
+                    if stopover.stop.id not in seen_stops:
+                        seen_stops.add(stopover.stop.id)
+                        stops_rows.append(
+                            stop_row(
+                                stopover.stop.id,
+                                station_metadata.name,
+                                station_metadata.lat,
+                                station_metadata.lon,
+                                config["data"]["timezone"],
+                            )
+                        )
                     if not stopover.departure and not stopover.arrival:
                         print("Skipping", stopover.stop.name, "because it has neither arrival nor departure time")
                         continue
 
-                    cur.execute(
-                        """insert or replace into stop_times values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                        (
-                            sha256(trip.id.encode()).hexdigest(),
+                    stop_times_rows.append(
+                        stop_time_row(
+                            trip_hash,
                             time_to_gtfs(
-                                trip.departure.date(),
+                                day_start_timestamp,
                                 (stopover.arrival if stopover.arrival else stopover.departure),
                             ),
                             time_to_gtfs(
-                                trip.departure.date(),
+                                day_start_timestamp,
                                 (stopover.departure if stopover.departure else stopover.arrival),
                             ),
                             stopover.stop.id,
-                            None,
-                            None,
                             sequence,
-                            None,
-                            None,
-                            None,
-                            1,  # exact times
-                        ),
+                        )
                     )
                     sequence += 1
 
+                    stopovers_since_flush += 1
+                    if stopovers_since_flush >= 5000:
+                        flush_rows(write_queue)
+                        stopovers_since_flush = 0
+
             latest_time_end = min(
                 latest_departure,
                 latest_arrival,
@@ -402,7 +696,13 @@ for search_name in config["data"]["stations"]:
             print(f"Fetched until {latest_time_end}")
 
             print("Writing changes to database…")
-            db.commit()
+            flush_rows(write_queue)
+            # Make sure everything is committed before recording the
+            # timestamp of this page
+            write_queue.join()
+            if writer_error is not None:
+                raise writer_error
+            stopovers_since_flush = 0
 
             if departures:
                 with open(
@@ -421,45 +721,38 @@ for search_name in config["data"]["stations"]:
             print("Stopping because of", e)
             break
 
+flush_rows(write_queue)
+write_queue.put(None)
+write_queue.join()
+writer_thread.join()
+if writer_error is not None:
+    raise writer_error
 
 if not os.path.exists("out"):
     os.makedirs("out")
 
-subprocess.run(
-    ["sqlite3", "../" + database_file],
-    input=""".headers on
-.mode csv
-.output stops.txt
-select * from stops;
-.output trips.txt
-select * from trips;
-.output routes.txt
-select * from routes;
-.output agency.txt
-select * from agencies;
-.output stop_times.txt
-select * from stop_times;
-.output calendar_dates.txt
-select * from calendar_dates;
-.output feed_info.txt
-select * from feed_info;
-""",
-    text=True,
-    check=True,
-    cwd="out",
-)
+for table, filename in [
+    ("stops", "stops.txt"),
+    ("trips", "trips.txt"),
+    ("routes", "routes.txt"),
+    ("agencies", "agency.txt"),
+    ("stop_times", "stop_times.txt"),
+    ("calendar_dates", "calendar_dates.txt"),
+    ("feed_info", "feed_info.txt"),
+]:
+    cur.execute(f"select * from {table}")
+    with open(Path("out") / filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([column[0] for column in cur.description])
+        writer.writerows(cur)
 
 output_filename = f"{config["operator"]["id"]}.gtfs.zip"
 
-files = list(map(lambda p: p.name, Path("out").glob("*.txt")))
-subprocess.check_call(
-    [
-        "zip",
-        "../" + output_filename,
-    ]
-    + files,
-    cwd="out",
-)
+# gtfsclean rewrites the archive below anyway, so a fast compression
+# level is enough here
+with zipfile.ZipFile(output_filename, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+    for path in Path("out").glob("*.txt"):
+        archive.write(path, arcname=path.name)
 
 subprocess.check_call(
     [